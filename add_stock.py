@@ -1,53 +1,101 @@
 import os
 import re
-import requests
-from sheet_manager import SheetManager
+import time
+from collections import defaultdict, deque
+from sheet_manager import SheetManager, format_change
+from http_session import build_session, response_json, telegram_url
+
+_SESSION = build_session()
+
+_CODE_RE = re.compile(r"\d{6}")
+_DATE_RE = re.compile(r"\d{4}[-/]\d{2}[-/]\d{2}")
+_NUM_RE = re.compile(r"\d+\.?\d*")
+_FILLER_RE = re.compile(r"关注|add")
+_REMOVE_KEYWORDS = ("删除", "移除", "del", "remove", "取消")
+_OFFSET_FILE = ".tg_offset"
+# Telegram 限额：全局 30 条/秒，单个会话 20 条/分钟；记录最近发送时间做 antiflood
+_LAST_SENT = deque(maxlen=30)
+_CHAT_SENT = defaultdict(lambda: deque(maxlen=20))
+
+def load_offset():
+    try:
+        with open(_OFFSET_FILE, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def save_offset(offset):
+    with open(_OFFSET_FILE, "w", encoding="utf-8") as f:
+        f.write(str(offset))
 
 def get_telegram_updates(bot_token, offset=None):
-    url = f"https://api.telegram.org/bot{bot_token}/getUpdates"
-    params = {"timeout": 10}
+    url = telegram_url(bot_token, "getUpdates")
+    params = {"timeout": 25}
     if offset:
         params["offset"] = offset
     
     try:
-        resp = requests.get(url, params=params, timeout=15)
+        resp = _SESSION.get(url, params=params, timeout=30)
         if resp.status_code == 200:
-            return resp.json().get("result", [])
+            return response_json(resp).get("result", [])
     except Exception as e:
         print(f"   ⚠️ 获取 Telegram 消息失败: {e}")
     return []
 
+def _antiflood(chat_id):
+    for window, sent in ((1.0, _LAST_SENT), (60.0, _CHAT_SENT[chat_id])):
+        if len(sent) == sent.maxlen:
+            wait_s = window - (time.monotonic() - sent[0])
+            if wait_s > 0:
+                time.sleep(wait_s)
+    now = time.monotonic()
+    _LAST_SENT.append(now)
+    _CHAT_SENT[chat_id].append(now)
+
 def send_telegram_message(bot_token, chat_id, text):
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    url = telegram_url(bot_token, "sendMessage")
     data = {
         "chat_id": chat_id,
         "text": text,
         "parse_mode": "Markdown" # 开启 Markdown 以便支持等宽字体
     }
-    try:
-        requests.post(url, json=data, timeout=10)
-    except:
-        pass
+    for attempt in range(1, 4):
+        _antiflood(chat_id)
+        try:
+            resp = _SESSION.post(url, json=data, timeout=10)
+        except Exception as e:
+            print(f"   ⚠️ Telegram 发送失败: {e}")
+            return
+        if resp.status_code != 429:
+            if resp.status_code != 200:
+                print(f"   ⚠️ Telegram 发送失败: HTTP {resp.status_code} {resp.text[:200]}")
+            return
+        try:
+            retry_after = int(response_json(resp).get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            retry_after = 1
+        print(f"   ⚠️ Telegram 429 限流，等待 {retry_after}s 后重试 ({attempt}/3)")
+        time.sleep(retry_after + 0.1)
 
 def parse_command(text):
     text = text.strip()
-    code_match = re.search(r"\d{6}", text)
+    code_match = _CODE_RE.search(text)
     if not code_match: return None
     code = code_match.group()
     
     intent = "add"
-    if any(k in text for k in ["删除", "移除", "del", "remove", "取消"]):
+    if any(k in text for k in _REMOVE_KEYWORDS):
         intent = "remove"
     
-    remain_text = text.replace(code, "").replace("关注", "").replace("add", "")
+    remain_text = _FILLER_RE.sub("", text.replace(code, ""))
     
     date = ""
-    date_match = re.search(r"\d{4}[-/]\d{2}[-/]\d{2}", remain_text)
+    date_match = _DATE_RE.search(remain_text)
     if date_match:
         date = date_match.group()
         remain_text = remain_text.replace(date, "")
     
-    nums = re.findall(r"\d+\.?\d*", remain_text)
+    nums = _NUM_RE.findall(remain_text)
     price = ""
     qty = ""
     if len(nums) >= 1: price = nums[0]
@@ -57,21 +105,67 @@ def parse_command(text):
         "intent": intent, "code": code, "date": date, "price": price, "qty": qty
     }
 
+def apply_commands(sm, commands):
+    """按消息顺序执行指令，返回每条的结果文本。
+    连续的新增/更新合并为一次 add_or_update_many，连续的删除合并为一次 remove_many；
+    指令类型切换时先提交已累积的一组，保证先后顺序"""
+    results = [""] * len(commands)
+    pending, pending_idx = {}, []
+
+    def flush():
+        if not pending_idx:
+            return
+        if commands[pending_idx[0]]["intent"] == "remove":
+            try:
+                removed = set(sm.remove_many(pending)["removed"])
+                for i in pending_idx:
+                    code = commands[i]["code"]
+                    results[i] = f"🗑️ 已移除 {code}" if code in removed else f"⚠️ 未找到 {code}"
+            except Exception as e:
+                for i in pending_idx:
+                    results[i] = f"❌ 删除失败: {e}"
+        else:
+            try:
+                outcome = sm.add_or_update_many(pending)
+                added, unchanged = set(outcome["added"]), set(outcome["unchanged"])
+                for i in pending_idx:
+                    p = commands[i]
+                    if p["code"] in added:
+                        action_type = "🆕 新增关注"
+                    else:
+                        action_type = "✅ 无变化" if p["code"] in unchanged else "✅ 已更新"
+                    results[i] = format_change(action_type, p["code"], p["date"], p["price"], p["qty"])
+            except Exception as e:
+                for i in pending_idx:
+                    results[i] = f"❌ 操作失败: {e}"
+        pending.clear()
+        pending_idx.clear()
+
+    for i, parsed in enumerate(commands):
+        if pending_idx and commands[pending_idx[0]]["intent"] != parsed["intent"]:
+            flush()
+        merged = pending.setdefault(parsed["code"], {"date": "", "price": "", "qty": ""})
+        for key in ("date", "price", "qty"):
+            if parsed[key]:
+                merged[key] = parsed[key]
+        pending_idx.append(i)
+    flush()
+    return results
+
 def main():
     bot_token = os.getenv("TG_BOT_TOKEN")
     if not bot_token:
         print("❌ 缺少 TG_BOT_TOKEN")
         return
 
-    print("☁️ 正在连接 Google Sheets...")
     try:
-        sm = SheetManager()
-        print("✅ 表格连接成功")
+        sm = SheetManager()  # 只校验配置，首次读写时才认证并打开表格
     except Exception as e:
-        print(f"❌ 表格连接失败: {e}")
+        print(f"❌ 表格配置错误: {e}")
         return
 
-    updates = get_telegram_updates(bot_token)
+    # 带上次持久化的 offset 拉取，同时确认（丢弃）已处理过的消息
+    updates = get_telegram_updates(bot_token, offset=load_offset())
     if not updates:
         print("📭 无新消息")
         return
@@ -79,6 +173,7 @@ def main():
     print(f"📥 收到 {len(updates)} 条消息，开始处理...")
     
     max_update_id = 0
+    chat_ids, commands = [], []
     
     for update in updates:
         update_id = update["update_id"]
@@ -97,31 +192,28 @@ def main():
         if not parsed:
             print("     -> 忽略 (非指令)")
             continue
-            
-        # 1. 执行增删改操作
-        action_result = ""
-        if parsed["intent"] == "remove":
-            action_result = sm.remove_stock(parsed["code"])
-        else:
-            try:
-                action_result = sm.add_or_update_stock(
-                    parsed["code"], parsed["date"], parsed["price"], parsed["qty"]
-                )
-            except Exception as e:
-                action_result = f"❌ 操作失败: {e}"
+        chat_ids.append(chat_id)
+        commands.append(parsed)
+
+    if commands:
+        # 1. 执行增删改操作（同批消息合并写入）
+        action_results = apply_commands(sm, commands)
         
         # 2. 【关键】无论成功失败，都拉取最新的全量持仓
-        portfolio_summary = sm.get_portfolio_summary()
+        try:
+            portfolio_summary = sm.get_portfolio_summary()
+        except Exception as e:
+            portfolio_summary = f"\n❌ 表格连接失败: {e}"
         
         # 3. 拼接最终回复
-        final_reply = f"{action_result}\n{portfolio_summary}"
-        
-        print(f"     -> 结果已发送")
-        send_telegram_message(bot_token, chat_id, final_reply)
+        for chat_id, action_result in zip(chat_ids, action_results):
+            final_reply = f"{action_result}\n{portfolio_summary}"
+            send_telegram_message(bot_token, chat_id, final_reply)
+        print(f"     -> {len(commands)} 条结果已发送")
 
     if max_update_id > 0:
-        print(f"🧹 清理消息队列 (Offset: {max_update_id + 1})")
-        get_telegram_updates(bot_token, offset=max_update_id + 1)
+        print(f"💾 记录消息队列 Offset: {max_update_id + 1}")
+        save_offset(max_update_id + 1)
 
 if __name__ == "__main__":
     main()
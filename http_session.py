@@ -0,0 +1,60 @@
+import atexit
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson（C 实现）可选：已安装则用于收发 JSON，否则回退标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    """解析 str / bytes；orjson 直接吃 bytes，省去一次解码"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dumps_bytes(obj):
+    """序列化为 UTF-8 bytes，可直接作为请求体"""
+    return orjson.dumps(obj) if orjson else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def response_json(resp):
+    """替代 resp.json()：直接解析原始字节"""
+    return json_loads(resp.content)
+
+
+TELEGRAM_API = "https://api.telegram.org/bot{token}/{method}"
+
+
+def telegram_url(bot_token, method):
+    """Bot API 地址；拉取与发送共用同一个 Session，只拼接方法名"""
+    return TELEGRAM_API.format(token=bot_token, method=method)
+
+
+def build_adapter(pool_connections=16, pool_maxsize=32):
+    """连接池 + 退避重试的 HTTPAdapter，可挂到任意 Session（如 gspread 的 AuthorizedSession）上。
+
+    urllib3 默认不对 POST 做状态码重试，LLM / Telegram 的 POST 仍由调用方自行处理 429。
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+
+def build_session(pool_connections=16, pool_maxsize=32):
+    """带连接池 + 退避重试的共享 Session。"""
+    adapter = build_adapter(pool_connections, pool_maxsize)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # 进程退出时归还连接池里的 keep-alive 连接
+    atexit.register(session.close)
+    return session
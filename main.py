@@ -3,18 +3,62 @@ import time
 import requests
 from datetime import datetime, timedelta, timezone
 import pandas as pd
-import akshare as ak
-import mplfinance as mpf
-from openai import OpenAI
 import numpy as np
-import markdown
-from xhtml2pdf import pisa
-from sheet_manager import SheetManager
-import json
+from sheet_manager import SheetManager, format_stock_code
+from http_session import build_session, json_loads, json_dumps_bytes, response_json
 import random
 import re
+import hashlib
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from string import Template
 from typing import Optional
 
+# ==========================================
+# 限流：令牌桶（线程安全），替代逐只股票的固定冷却
+# ==========================================
+class RateLimiter:
+    """每 per 秒最多放行 rate 次调用，超出则阻塞等待令牌。"""
+    def __init__(self, rate: float, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate / self.per)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_s = (1 - self._tokens) * self.per / self.rate
+            time.sleep(wait_s)
+_DEEPSEEK_LIMITER = RateLimiter(3, 1.0)
+_GEMINI_LIMITER = RateLimiter(int(os.getenv("GEMINI_RPM", "10")), 60.0)
+# 各服务商收到 429 后的最早可调用时刻（monotonic），所有工作线程共享；无 429 时不等待
+_NEXT_OK_TIME = {"gemini": 0.0, "openai": 0.0, "deepseek": 0.0}
+_NEXT_OK_LOCK = threading.Lock()
+def defer_provider(name: str, seconds: float) -> None:
+    with _NEXT_OK_LOCK:
+        _NEXT_OK_TIME[name] = max(_NEXT_OK_TIME[name], time.monotonic() + seconds)
+def wait_provider(name: str, cancel_event: Optional[threading.Event] = None) -> None:
+    wait_s = _NEXT_OK_TIME[name] - time.monotonic()
+    if wait_s > 0:
+        if cancel_event:
+            cancel_event.wait(wait_s)
+        else:
+            time.sleep(wait_s)
+# 同时在途的 LLM 分析数上限（按配额调）；其余工作线程继续取数/绘图，与 LLM 等待重叠
+_LLM_SLOTS = threading.BoundedSemaphore(int(os.getenv("LLM_CONCURRENCY", "3")))
+# matplotlib / reportlab 均非线程安全，渲染阶段串行
+_RENDER_LOCK = threading.Lock()
+# 所有 LLM HTTP 调用复用同一连接池，省去每次 TCP+TLS 握手
+_SESSION = build_session()
+
 # ==========================================
 # 0) 保留原Gemini相关代码（作为备用，不删除）
 # ==========================================
@@ -24,69 +68,105 @@ class GeminiQuotaExceeded(Exception):
 class GeminiRateLimited(Exception):
     """短期速率限制：可退避重试。"""
     pass
-def _extract_retry_seconds(resp: requests.Response) -> int:
+class GeminiCancelled(Exception):
+    """对冲请求中另一路已先返回，放弃本次 Gemini 调用。"""
+    pass
+_RETRY_RE = re.compile(r"retry in\s+([\d\.]+)\s*s", re.IGNORECASE)
+_QUOTA_MARKERS = ("quota exceeded", "exceeded your current quota")
+def _error_body(resp: requests.Response) -> tuple:
+    """错误响应只解码、解析一次：(原文, error.message)，供下面两个判断共用"""
+    text = resp.text or ""
+    try:
+        msg = ((response_json(resp).get("error", {}) or {}).get("message", "") or "")
+    except:
+        msg = ""
+    return text, msg
+def _extract_retry_seconds(resp: requests.Response, body: Optional[tuple] = None) -> int:
     ra = resp.headers.get("Retry-After")
     if ra:
         try:
             return max(1, int(float(ra)))
         except:
             pass
-    text = resp.text or ""
-    m = re.search(r"retry in\s+([\d\.]+)\s*s", text, re.IGNORECASE)
+    text, msg = body or _error_body(resp)
+    m = _RETRY_RE.search(text) or _RETRY_RE.search(msg)
     if m:
         return max(1, int(float(m.group(1))))
-    try:
-        obj = resp.json()
-        msg = ((obj.get("error", {}) or {}).get("message", "") or "")
-        m2 = re.search(r"retry in\s+([\d\.]+)\s*s", msg, re.IGNORECASE)
-        if m2:
-            return max(1, int(float(m2.group(1))))
-    except:
-        pass
     return 0
-def _is_quota_exhausted(resp: requests.Response) -> bool:
-    text = (resp.text or "").lower()
-    if ("quota exceeded" in text) or ("exceeded your current quota" in text):
+def _is_quota_exhausted(resp: requests.Response, body: Optional[tuple] = None) -> bool:
+    text, msg = body or _error_body(resp)
+    text, msg = text.lower(), msg.lower()
+    if any(marker in text for marker in _QUOTA_MARKERS):
         return True
     if ("free_tier" in text) and ("limit" in text):
         return True
+    return any(marker in msg for marker in _QUOTA_MARKERS)
+# 请求体中与股票无关的部分只构建一次，每次调用只注入 contents
+_GEMINI_HEADERS = {"Content-Type": "application/json"}
+_GEMINI_BASE_BODY = {
+    "system_instruction": {"parts": [{"text": "You are Richard D. Wyckoff."}]},
+    "generationConfig": {"temperature": 0.2},
+    "safetySettings": [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ],
+}
+# 默认走 SSE 流式接口：边生成边接收，对冲另一路先返回时可中途断开
+GEMINI_STREAM = os.getenv("GEMINI_STREAM", "1") != "0"
+def _read_gemini_stream(resp: requests.Response, cancel_event: threading.Event) -> str:
+    """逐条读取 SSE 分片并拼接文本；每片之间检查取消"""
+    chunks = []
+    last = None
     try:
-        obj = resp.json()
-        msg = (((obj.get("error", {}) or {}).get("message", "")) or "").lower()
-        if ("quota exceeded" in msg) or ("exceeded your current quota" in msg):
-            return True
-    except:
-        pass
-    return False
-def call_gemini_http(prompt: str) -> str:
+        for line in resp.iter_lines():
+            if cancel_event.is_set():
+                raise GeminiCancelled("cancelled by hedged request")
+            if not line.startswith(b"data:"):
+                continue
+            last = json_loads(line[5:])
+            for candidate in (last.get("candidates") or [])[:1]:
+                for part in ((candidate.get("content") or {}).get("parts") or []):
+                    chunks.append(part.get("text", "") or "")
+    finally:
+        resp.close()
+    text = "".join(chunks)
+    if not text:
+        raise ValueError(f"Empty text. Raw={str(last)[:400]}")
+    return text
+def call_gemini_http(prompt: str, cancel_event: Optional[threading.Event] = None, json_mode: bool = False,
+                     max_retries: Optional[int] = None) -> str:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("GEMINI_API_KEY missing")
     model_name = os.getenv("GEMINI_MODEL") or "gemini-1.5-flash"
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-    session = requests.Session()
-    headers = {"Content-Type": "application/json"}
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
-    data = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "system_instruction": {"parts": [{"text": "You are Richard D. Wyckoff."}]},
-        "generationConfig": {"temperature": 0.2},
-        "safetySettings": safety_settings,
-    }
-    max_retries = int(os.getenv("GEMINI_MAX_RETRIES", "8"))
+    if GEMINI_STREAM:
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:streamGenerateContent?alt=sse&key={api_key}"
+    else:
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+    session = _SESSION
+    # 只序列化一次，重试时直接复用同一份字节
+    data = {**_GEMINI_BASE_BODY, "contents": [{"parts": [{"text": prompt}]}]}
+    if json_mode:
+        data["generationConfig"] = {**data["generationConfig"], "responseMimeType": "application/json"}
+    body = json_dumps_bytes(data)
+    max_retries = max_retries or int(os.getenv("GEMINI_MAX_RETRIES", "8"))
     base_sleep = float(os.getenv("GEMINI_BASE_SLEEP", "2.5"))
     timeout_s = int(os.getenv("GEMINI_TIMEOUT", "300"))
+    cancel_event = cancel_event or threading.Event()
     last_err: Optional[Exception] = None
     for attempt in range(1, max_retries + 1):
         try:
-            resp = session.post(url, headers=headers, json=data, timeout=timeout_s)
+            wait_provider("gemini", cancel_event)
+            if cancel_event.is_set():
+                raise GeminiCancelled("cancelled by hedged request")
+            _GEMINI_LIMITER.acquire()
+            resp = session.post(url, headers=_GEMINI_HEADERS, data=body, timeout=timeout_s, stream=GEMINI_STREAM)
+            if resp.status_code == 200 and GEMINI_STREAM:
+                return _read_gemini_stream(resp, cancel_event)
             if resp.status_code == 200:
-                result = resp.json()
+                result = response_json(resp)
                 candidates = result.get("candidates", []) or []
                 if not candidates:
                     raise ValueError(f"No candidates. Raw={str(result)[:400]}")
@@ -99,25 +179,27 @@ def call_gemini_http(prompt: str) -> str:
                     raise ValueError(f"Empty text. Raw={str(result)[:400]}")
                 return text
             if resp.status_code == 429:
-                if _is_quota_exhausted(resp):
+                body_429 = _error_body(resp)
+                if _is_quota_exhausted(resp, body_429):
                     raise GeminiQuotaExceeded(resp.text[:1200])
-                retry_s = _extract_retry_seconds(resp)
+                retry_s = _extract_retry_seconds(resp, body_429)
                 if retry_s <= 0:
                     retry_s = int(base_sleep * (2 ** (attempt - 1)) + random.random() * 2)
+                defer_provider("gemini", retry_s)
                 if attempt == max_retries:
                     raise GeminiRateLimited(resp.text[:1200])
                 print(f"   ⚠️ Gemini 429(短期限流)，等待 {retry_s}s 后重试 ({attempt}/{max_retries})", flush=True)
-                time.sleep(retry_s)
+                cancel_event.wait(retry_s)
                 continue
             if resp.status_code == 503:
                 retry_s = int(base_sleep * (2 ** (attempt - 1)) + random.random() * 2)
                 if attempt == max_retries:
                     raise Exception(f"Gemini 503 final: {resp.text[:1200]}")
                 print(f"   ⚠️ Gemini 503(过载)，等待 {retry_s}s 后重试 ({attempt}/{max_retries})", flush=True)
-                time.sleep(retry_s)
+                cancel_event.wait(retry_s)
                 continue
             raise Exception(f"Gemini HTTP {resp.status_code}: {resp.text[:1200]}")
-        except GeminiQuotaExceeded:
+        except (GeminiQuotaExceeded, GeminiCancelled):
             raise
         except Exception as e:
             last_err = e
@@ -125,18 +207,56 @@ def call_gemini_http(prompt: str) -> str:
                 raise
             retry_s = int(base_sleep * (2 ** (attempt - 1)) + random.random() * 2)
             print(f"   ⚠️ Gemini 调用异常：{str(e)[:200]}... 等待 {retry_s}s 重试 ({attempt}/{max_retries})", flush=True)
-            time.sleep(retry_s)
+            cancel_event.wait(retry_s)
     raise last_err or Exception("Gemini unknown failure")
 
 # ==========================================
 # 新增：硅基流动DeepSeek调用函数（严格按官方示例）
 # ==========================================
+_DEEPSEEK_SYSTEM_PROMPT = "You are Richard D. Wyckoff. 基于威科夫理论分析股票量价数据，识别Spring、UT、LPS等关键结构，结合用户持仓成本提供Hold/Sell/Stop-Loss建议，分析专业简洁，用中文输出。"
 def call_deepseek_siliconflow(prompt: str) -> str:
     """
     调用硅基流动DeepSeek API（官方格式）
     模型：deepseek-ai/DeepSeek-V3.1-Terminus
     密钥：从环境变量DEEPSEEK_API_KEY获取（已配置在Secrets）
     """
+    return _deepseek_chat(prompt)
+def build_batch_prompt(prompts: dict) -> str:
+    """多只股票合并为一条 prompt，要求按 JSON 返回：{"analyses": {代码: 报告}}"""
+    sections = "\n\n".join(f"## STOCK {symbol}\n{prompt}" for symbol, prompt in prompts.items())
+    instruction = (
+        f"以下共有 {len(prompts)} 只股票，每只以 '## STOCK <代码>' 开头，请分别独立完成分析。\n"
+        '只输出 JSON：{"analyses": {"<代码>": "<该股票的完整 Markdown 报告>", ...}}\n\n'
+    )
+    return instruction + sections
+def split_batch_reply(content: str, prompts: dict) -> dict:
+    """按 JSON 拆回各自报告；缺失或为空的代码由调用方逐只兜底"""
+    analyses = (json_loads(content).get("analyses") or {})
+    return {symbol: str(text) for symbol, text in analyses.items() if symbol in prompts and str(text).strip()}
+def call_deepseek_siliconflow_batch(prompts: dict) -> dict:
+    """多只股票合并为一次 DeepSeek 请求：{代码: 报告}"""
+    content = _deepseek_chat(
+        build_batch_prompt(prompts),
+        max_tokens=min(2048 * len(prompts), 8192),
+        response_format={"type": "json_object"},
+    )
+    return split_batch_reply(content, prompts)
+# 批量只是逐只分析前的捷径：少重试、限总时长，超时即取消，交给逐只流程（逐只流程另有对冲）
+GEMINI_BATCH_RETRIES = int(os.getenv("GEMINI_BATCH_RETRIES", "2"))
+GEMINI_BATCH_DEADLINE = float(os.getenv("GEMINI_BATCH_DEADLINE", "120"))
+def call_gemini_http_batch(prompts: dict) -> dict:
+    """DeepSeek 批量失败时的备用：同样合并为一次 Gemini 请求（JSON 输出模式）"""
+    cancel_event = threading.Event()
+    deadline = threading.Timer(GEMINI_BATCH_DEADLINE, cancel_event.set)
+    deadline.daemon = True
+    deadline.start()
+    try:
+        text = call_gemini_http(build_batch_prompt(prompts), cancel_event, json_mode=True,
+                                max_retries=GEMINI_BATCH_RETRIES)
+    finally:
+        deadline.cancel()
+    return split_batch_reply(text, prompts)
+def _deepseek_chat(prompt: str, max_tokens: int = 2048, response_format: Optional[dict] = None) -> str:
     # 1. 获取API密钥
     api_key = os.getenv("DEEPSEEK_API_KEY")
     if not api_key:
@@ -155,24 +275,31 @@ def call_deepseek_siliconflow(prompt: str) -> str:
     data = {
         "model": "deepseek-ai/DeepSeek-V3.1-Terminus",  # 官方指定模型名
         "messages": [
-            {"role": "system", "content": "You are Richard D. Wyckoff. 基于威科夫理论分析股票量价数据，识别Spring、UT、LPS等关键结构，结合用户持仓成本提供Hold/Sell/Stop-Loss建议，分析专业简洁，用中文输出。"},
+            {"role": "system", "content": _DEEPSEEK_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
         "temperature": 0.2,  # 与原Gemini保持一致，保证分析稳定
-        "max_tokens": 2048    # 限制最大输出长度
+        "max_tokens": max_tokens    # 限制最大输出长度
     }
+    if response_format:
+        data["response_format"] = response_format
     
     # 5. 发送请求（带重试逻辑，避免网络抖动）
-    session = requests.Session()
+    session = _SESSION
     max_retries = 3
     base_sleep = 3
     last_err: Optional[Exception] = None
     
+    body = json_dumps_bytes(data)
     for attempt in range(1, max_retries + 1):
         try:
-            resp = session.post(url, headers=headers, json=data, timeout=60)
+            wait_provider("deepseek")
+            _DEEPSEEK_LIMITER.acquire()
+            resp = session.post(url, headers=headers, data=body, timeout=60)
+            if resp.status_code == 429:
+                defer_provider("deepseek", _extract_retry_seconds(resp) or base_sleep)
             resp.raise_for_status()  # 非200状态码直接抛异常
-            result = resp.json()
+            result = response_json(resp)
             
             # 解析返回结果
             choices = result.get("choices", [])
@@ -198,81 +325,288 @@ def call_deepseek_siliconflow(prompt: str) -> str:
     raise last_err or Exception("DeepSeek未知错误")
 
 # ==========================================
-# 1. 数据获取模块（完全保留原代码，不修改）
+# 1. 数据获取模块
 # ==========================================
-def fetch_stock_data_dynamic(symbol: str, buy_date_str: str) -> dict:
-    clean_digits = ''.join(filter(str.isdigit, str(symbol)))
-    symbol_code = clean_digits.zfill(6)
-    start_date_em = (datetime.now() - timedelta(days=40)).strftime("%Y%m%d")
+# K线缓存：key=(代码, 周期, 起始日, 截止日) -> (写入时间, DataFrame)，未命中时落盘到 .cache/klines
+# 返回的原始 DataFrame 与缓存共享，调用方只读（build_kline_frame 逐列拷出后再处理）
+_KLINE_CACHE: dict = {}
+_KLINE_INFLIGHT: dict = {}  # 正在拉取的 key -> Future，同一只股票只发一次请求，其余线程等结果
+_KLINE_LOCK = threading.RLock()
+_KLINE_CACHE_DIR = ".cache/klines"
+# 东方财富接口并发上限：预取线程池与单只补拉共用，避免触发限流
+EASTMONEY_CONC = int(os.getenv("EASTMONEY_CONC") or os.getenv("FETCH_WORKERS") or "4")
+_EASTMONEY_SLOTS = threading.BoundedSemaphore(EASTMONEY_CONC)
+KLINE_BARS = 500
+# 5 分钟线每个交易日 48 根；按周历折算自然日，再留 14 天覆盖长假，只请求够用的区间
+KLINE_LOOKBACK_DAYS = -(-KLINE_BARS // 48) * 7 // 5 + 14
+def kline_date_range(now: Optional[datetime] = None) -> tuple:
+    """(起始日, 截止日)，每轮批处理只计算一次"""
+    now = now or datetime.now()
+    return (now - timedelta(days=KLINE_LOOKBACK_DAYS)).strftime("%Y%m%d"), now.strftime("%Y%m%d")
+# 当日K线缓存有效期（秒）；调试 prompt 反复重跑时可调大，避免重复拉取
+KLINE_CACHE_TTL = float(os.getenv("KLINE_CACHE_TTL", "300"))
+def _kline_ttl(period: str, end_date: str) -> float:
+    if end_date < datetime.now().strftime("%Y%m%d"):
+        return float("inf")  # 历史K线不会再变
+    return min(30, KLINE_CACHE_TTL) if period == "1" else KLINE_CACHE_TTL
+def fetch_hist_min_cached(symbol_code: str, period: str, start_date: str, end_date: str) -> pd.DataFrame:
+    key = (symbol_code, period, start_date, end_date)
+    ttl = _kline_ttl(period, end_date)
+    with _KLINE_LOCK:
+        hit = _KLINE_CACHE.get(key)
+        if hit and time.time() - hit[0] < ttl:
+            return hit[1]
+        cache_path = os.path.join(_KLINE_CACHE_DIR, f"{symbol_code}_{period}_{start_date}_{end_date}.pkl")
+        if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ttl:
+            try:
+                df = pd.read_pickle(cache_path)
+                _KLINE_CACHE[key] = (os.path.getmtime(cache_path), df)
+                return df
+            except Exception:
+                pass
+        inflight = _KLINE_INFLIGHT.get(key)
+        if inflight is None:
+            _KLINE_INFLIGHT[key] = Future()
+    if inflight is not None:
+        try:
+            return inflight.result()
+        except Exception:
+            # 等到的是别人（如后台预取）的失败：自己独立重试一次，异常由本调用方报告
+            return _download_hist_min(symbol_code, period, start_date, key, cache_path)
     try:
-        df = ak.stock_zh_a_hist_min_em(symbol=symbol_code, period="5", start_date=start_date_em, adjust="qfq")
+        df = _download_hist_min(symbol_code, period, start_date, key, cache_path)
+    except Exception as e:
+        with _KLINE_LOCK:
+            _KLINE_INFLIGHT.pop(key).set_exception(e)
+        raise
+    with _KLINE_LOCK:
+        _KLINE_INFLIGHT.pop(key).set_result(df)
+    return df
+def _download_hist_min(symbol_code: str, period: str, start_date: str, key: tuple, cache_path: str) -> pd.DataFrame:
+    import akshare as ak  # 延迟导入：冷启动时不加载 akshare 全家桶
+    with _EASTMONEY_SLOTS:
+        df = ak.stock_zh_a_hist_min_em(symbol=symbol_code, period=period, start_date=start_date, adjust="qfq")
+    if df.empty:
+        return df
+    with _KLINE_LOCK:
+        _KLINE_CACHE[key] = (time.time(), df)
+        try:
+            os.makedirs(_KLINE_CACHE_DIR, exist_ok=True)
+            df.to_pickle(cache_path)
+        except Exception as e:
+            print(f"   ⚠️ [{symbol_code}] K线缓存写入失败: {e}", flush=True)
+    return df
+def prune_kline_cache(end_date: str) -> None:
+    """删除截止日早于 end_date 的K线缓存文件（本轮不会再命中），防止缓存目录无限增长"""
+    if not os.path.isdir(_KLINE_CACHE_DIR):
+        return
+    for name in os.listdir(_KLINE_CACHE_DIR):
+        stem, ext = os.path.splitext(name)
+        if ext == ".pkl" and stem.rsplit("_", 1)[-1] < end_date:
+            try:
+                os.remove(os.path.join(_KLINE_CACHE_DIR, name))
+            except OSError:
+                pass
+def prefetch_klines(symbols, date_range: Optional[tuple] = None, block: bool = True) -> None:
+    """批量并发预取K线，预热 _KLINE_CACHE；失败的会打印，等待同一请求的单只流程收到失败后会自行重试一次。
+    block=False 时后台预取、立即返回：分析线程取数时命中缓存或等待同一请求，前面股票的 LLM 调用与后面股票的取数重叠"""
+    start_date_em, end_date = date_range or kline_date_range()
+    prune_kline_cache(end_date)
+    codes = [format_stock_code(s) for s in symbols]
+    pool = ThreadPoolExecutor(max_workers=EASTMONEY_CONC)
+    futures = [(code, pool.submit(fetch_hist_min_cached, code, "5", start_date_em, end_date)) for code in codes]
+    pool.shutdown(wait=False)
+    def report(code, fut):
+        if fut.exception() is not None:  # 未完成时阻塞等待
+            print(f"   ⚠️ [{code}] 预取K线失败: {fut.exception()}", flush=True)
+    for code, fut in futures:
+        if block:
+            report(code, fut)
+        else:
+            fut.add_done_callback(lambda f, code=code: report(code, f))
+# 价格 float32、成交量 uint32：内存减半，plot/prompt/PDF 共用同一份 DataFrame
+_KLINE_COLS = {"时间": "date", "开盘": "open", "最高": "high", "最低": "low", "收盘": "close", "成交量": "volume"}
+def dual_sma(close: np.ndarray, w1: int, w2: int) -> tuple:
+    """一次前缀和同时得到两条简单均线（窗口不足或窗口内含 NaN 处为 NaN，与 rolling(w).mean() 一致）"""
+    nan = np.isnan(close)
+    csum = np.concatenate(([0.0], np.cumsum(np.where(nan, 0.0, close), dtype=np.float64)))
+    ncnt = np.concatenate(([0], np.cumsum(nan))) if nan.any() else None
+    def sma(w):
+        out = np.full(close.shape, np.nan)
+        if len(close) >= w:
+            out[w - 1:] = (csum[w:] - csum[:-w]) / w
+            if ncnt is not None:
+                out[w - 1:][(ncnt[w:] - ncnt[:-w]) > 0] = np.nan
+        return out
+    return sma(w1), sma(w2)
+def _numeric(s: pd.Series) -> pd.Series:
+    """非数值列（object / pandas 3 的 str）做数值解析，无法解析的记为 NaN；已是数值的列直接返回，不重复转换"""
+    return s if pd.api.types.is_numeric_dtype(s) else pd.to_numeric(s, errors="coerce")
+def _fill_zero_open(opens: np.ndarray, closes: np.ndarray) -> np.ndarray:
+    """开盘价为 0 或缺失的K线原地回填为前一根收盘价（首根或前值缺失用自身收盘价）；向量化，无需逐根循环"""
+    zero = np.flatnonzero((opens == 0) | np.isnan(opens))
+    if zero.size:
+        prev = np.maximum(zero - 1, 0)
+        fill = closes[prev]
+        opens[zero] = np.where((zero == 0) | np.isnan(fill), closes[zero], fill)
+    return opens
+def build_kline_frame(raw: pd.DataFrame, bars: int = KLINE_BARS) -> pd.DataFrame:
+    """清洗 + 指标一次完成：先截取最后 bars 根，逐列转 NumPy 处理，最后只组装一次 DataFrame"""
+    # 多留一根：首根开盘价回填要用它前一根的收盘价，回填后再丢掉
+    raw = raw.iloc[-(bars + 1):]
+    keep = slice(1, None) if len(raw) > bars else slice(None)
+    cols, prices = {}, []
+    for src in raw.columns:
+        dst = _KLINE_COLS.get(src)
+        if dst is None:
+            cols[src] = raw[src].to_numpy()[keep]  # 涨跌幅/成交额/换手率等原样保留，数据快照列与列序不变
+        elif dst == "date":
+            cols[dst] = pd.to_datetime(raw[src].to_numpy()[keep])
+        elif dst == "volume":
+            cols[dst] = np.nan_to_num(_numeric(raw[src]).to_numpy(dtype=np.float64)[keep]).astype(np.uint32)
+        else:
+            cols[dst] = _numeric(raw[src]).to_numpy(dtype=np.float64, copy=True)
+            prices.append(dst)
+    if "open" in cols and "close" in cols:
+        _fill_zero_open(cols["open"], cols["close"])
+    for dst in prices:
+        cols[dst] = cols[dst][keep]
+    if "close" in cols:
+        # 均线用 float64 收盘价计算，再把价格列降为 float32
+        cols["ma50"], cols["ma200"] = dual_sma(cols["close"], 50, 200)
+    for dst in prices:
+        cols[dst] = cols[dst].astype(np.float32)
+    return pd.DataFrame(cols)
+def fetch_stock_data_dynamic(symbol: str, buy_date_str: str, date_range: Optional[tuple] = None) -> dict:
+    symbol_code = format_stock_code(symbol)
+    start_date_em, end_date = date_range or kline_date_range()
+    try:
+        df = fetch_hist_min_cached(symbol_code, "5", start_date_em, end_date)
     except Exception as e:
         print(f"   [Error] {symbol_code} AkShare接口报错: {e}", flush=True)
         return {"df": pd.DataFrame(), "period": "5m"}
     if df.empty:
         return {"df": pd.DataFrame(), "period": "5m"}
-    rename_map = {"时间": "date", "开盘": "open", "最高": "high", "最低": "low", "收盘": "close", "成交量": "volume"}
-    df = df.rename(columns={k: v for k, v in rename_map.items() if k in df.columns})
-    if "date" in df.columns:
-        df["date"] = pd.to_datetime(df["date"])
-    cols = ["open", "high", "low", "close", "volume"]
-    valid_cols = [c for c in cols if c in df.columns]
-    df[valid_cols] = df[valid_cols].astype(float)
-    if "open" in df.columns and (df["open"] == 0).any():
-        df["open"] = df["open"].replace(0, np.nan)
-        if "close" in df.columns:
-            df["open"] = df["open"].fillna(df["close"].shift(1)).fillna(df["close"])
-    if len(df) > 500:
-        df = df.tail(500).reset_index(drop=True)
-    return {"df": df, "period": "5m"}
-def add_indicators(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    if "close" in df.columns:
-        df["ma50"] = df["close"].rolling(50).mean()
-        df["ma200"] = df["close"].rolling(200).mean()
-    return df
+    return {"df": build_kline_frame(df), "period": "5m"}
 
 # ==========================================
-# 2. 绘图模块（完全保留原代码，不修改）
+# 2. 绘图模块
 # ==========================================
-def generate_local_chart(symbol: str, df: pd.DataFrame, save_path: str, period: str):
+_MPF_STYLE = None
+def _load_mpf():
+    """延迟导入 mplfinance（连带 matplotlib），样式只构建一次"""
+    global _MPF_STYLE
+    if _MPF_STYLE is None:
+        import matplotlib
+        matplotlib.use("Agg")  # 无界面环境，跳过 GUI 后端探测
+    import mplfinance as mpf
+    if _MPF_STYLE is None:
+        with _RENDER_LOCK:
+            if _MPF_STYLE is None:
+                _MPF_STYLE = mpf.make_mpf_style(
+                    base_mpf_style='yahoo',
+                    marketcolors=mpf.make_marketcolors(
+                        up='#ff3333',
+                        down='#00b060',
+                        edge='inherit',
+                        wick='inherit',
+                        volume={'up': '#ff3333', 'down': '#00b060'},
+                        inherit=True
+                    ),
+                    gridstyle=':',
+                    y_on_right=True
+                )
+    return mpf, _MPF_STYLE
+# 最新K线未变化时直接复用上次渲染的图（按 代码+周期+末根K线 取哈希）
+_PLOT_CACHE_DIR = ".cache/plots"
+_PLOT_CACHE_TTL = 300
+# PDF 中图宽 18cm，100dpi 已足够清晰；不用 bbox_inches='tight'，省去一次测量用的整图重绘
+CHART_DPI = int(os.getenv("CHART_DPI", "100"))
+def _chart_cache_path(symbol: str, df: pd.DataFrame, period: str) -> str:
+    # 按列取标量，避免 iloc[-1] 为整行装箱一个 object Series
+    last_date = df["date"].iat[-1] if "date" in df.columns else ""
+    last_close = df["close"].iat[-1] if "close" in df.columns else ""
+    key = f"{symbol}|{period}|{last_date}|{last_close}|{len(df)}"
+    return os.path.join(_PLOT_CACHE_DIR, hashlib.md5(key.encode("utf-8")).hexdigest() + ".png")
+# CHART_REUSE_FIG=1 时所有股票复用同一个 Figure/Axes（外部 Axes 模式，版式与默认面板略有不同，默认关闭）
+CHART_REUSE_FIG = os.getenv("CHART_REUSE_FIG", "0") == "1"
+_CHART_FIGS: dict = {}  # id(style) -> (fig, 主图 ax, 成交量 ax)，仅在 _RENDER_LOCK 内访问
+_MA_LINES = (("ma50", "#ff9900", 1.5), ("ma200", "#2196f3", 2.0))
+def _reusable_axes(mpf, style) -> tuple:
+    fig_axes = _CHART_FIGS.get(id(style))
+    if fig_axes is None:
+        fig = mpf.figure(style=style, figsize=(10, 7))
+        gs = fig.add_gridspec(2, 1, height_ratios=(3, 1), hspace=0.05)
+        ax_price = fig.add_subplot(gs[0])
+        ax_volume = fig.add_subplot(gs[1], sharex=ax_price)
+        fig_axes = _CHART_FIGS[id(style)] = (fig, ax_price, ax_volume)
+    else:
+        for ax in fig_axes[1:]:
+            ax.clear()
+    return fig_axes
+def generate_local_chart(symbol: str, df: pd.DataFrame, save_path: str, period: str, style=None):
     if df.empty:
         return
-    plot_df = df.copy()
-    if "date" in plot_df.columns:
-        plot_df.set_index("date", inplace=True)
-    mc = mpf.make_marketcolors(
-        up='#ff3333',
-        down='#00b060',
-        edge='inherit',
-        wick='inherit',
-        volume={'up': '#ff3333', 'down': '#00b060'},
-        inherit=True
-    )
-    s = mpf.make_mpf_style(base_mpf_style='yahoo', marketcolors=mc, gridstyle=':', y_on_right=True)
-    apds = []
-    if 'ma50' in plot_df.columns:
-        apds.append(mpf.make_addplot(plot_df['ma50'], color='#ff9900', width=1.5))
-    if 'ma200' in plot_df.columns:
-        apds.append(mpf.make_addplot(plot_df['ma200'], color='#2196f3', width=2.0))
+    cache_path = _chart_cache_path(symbol, df, period)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) > time.time() - _PLOT_CACHE_TTL:
+        shutil.copyfile(cache_path, save_path)
+        return
+    # set_index 返回新对象，原 df 不受影响，无需先整表 copy
+    plot_df = df.set_index("date") if "date" in df.columns else df
+    mpf, s = _load_mpf()
+    s = style or s
+    title = f"Wyckoff: {symbol} ({period} | {len(plot_df)} bars)"
     try:
-        mpf.plot(
-            plot_df,
-            type='candle',
-            style=s,
-            addplot=apds,
-            volume=True,
-            title=f"Wyckoff: {symbol} ({period} | {len(plot_df)} bars)",
-            savefig=dict(fname=save_path, dpi=150, bbox_inches='tight'),
-            warn_too_much_data=2000
-        )
+        with _RENDER_LOCK:
+            if CHART_REUSE_FIG:
+                fig, ax_price, ax_volume = _reusable_axes(mpf, s)
+                apds = [mpf.make_addplot(plot_df[c], color=color, width=width, ax=ax_price)
+                        for c, color, width in _MA_LINES if c in plot_df.columns]
+                mpf.plot(plot_df, type='candle', ax=ax_price, volume=ax_volume, addplot=apds, warn_too_much_data=2000)
+                ax_price.set_title(title)
+                fig.savefig(save_path, dpi=CHART_DPI)
+            else:
+                apds = [mpf.make_addplot(plot_df[c], color=color, width=width)
+                        for c, color, width in _MA_LINES if c in plot_df.columns]
+                mpf.plot(
+                    plot_df,
+                    type='candle',
+                    style=s,
+                    addplot=apds,
+                    volume=True,
+                    title=title,
+                    savefig=dict(fname=save_path, dpi=CHART_DPI),
+                    warn_too_much_data=2000
+                )
+        os.makedirs(_PLOT_CACHE_DIR, exist_ok=True)
+        shutil.copyfile(save_path, cache_path)
     except Exception as e:
         print(f"   [Error] {symbol} 绘图失败: {e}", flush=True)
 
 # ==========================================
 # 3. AI 分析模块（核心修改：优先调用DeepSeek）
 # ==========================================
-_PROMPT_CACHE = None
+_PROMPT_CACHE = None  # 编译后的 Template；无模板时为 False
+_PROMPT_FIELDS = ("symbol", "latest_time", "latest_price", "csv_data")
+def compile_prompt_template(raw: str) -> Template:
+    """{field} 占位符转为 ${field}，原文中的 $ 先转义；持仓段落作为末尾占位符，每只股票单次替换"""
+    escaped = raw.replace("$", "$$")
+    for name in _PROMPT_FIELDS:
+        escaped = escaped.replace("{%s}" % name, "${%s}" % name)
+    return Template(escaped + "${position_text}")
+_PAYLOAD_COLS = ["date", "open", "high", "low", "close", "volume", "ma50", "ma200"]
+_PAYLOAD_PRICE_COLS = ["open", "high", "low", "close", "ma50", "ma200"]
+_PAYLOAD_DATE_FMT = "%Y-%m-%d %H:%M"  # 分钟线秒位恒为 00，去掉省 token
+# 喂给 LLM 的K线根数（均线已在全量数据上算好）；调小可按比例减少输入 token
+PROMPT_BARS = int(os.getenv("PROMPT_BARS", str(KLINE_BARS)))
+def format_kline_payload(df: pd.DataFrame) -> str:
+    """压缩喂给 LLM 的K线：只保留量价列，价格两位小数、成交量取整，表头即字段说明"""
+    sub = df[[c for c in _PAYLOAD_COLS if c in df.columns]].tail(PROMPT_BARS).copy()
+    price_cols = [c for c in _PAYLOAD_PRICE_COLS if c in sub.columns]
+    sub[price_cols] = sub[price_cols].round(2)
+    if "volume" in sub.columns:
+        sub["volume"] = sub["volume"].fillna(0).round().astype("int64")
+    return sub.to_csv(index=False, lineterminator="\n", date_format=_PAYLOAD_DATE_FMT)
 def get_prompt_content(symbol, df, position_info):
     global _PROMPT_CACHE
     if _PROMPT_CACHE is None:
@@ -283,18 +617,10 @@ def get_prompt_content(symbol, df, position_info):
                     prompt_template = f.read()
             except:
                 prompt_template = None
-        _PROMPT_CACHE = prompt_template
+        _PROMPT_CACHE = compile_prompt_template(prompt_template) if prompt_template else False
     prompt_template = _PROMPT_CACHE
     if not prompt_template:
         return None
-    csv_data = df.to_csv(index=False)
-    latest = df.iloc[-1]
-    base_prompt = (
-        prompt_template.replace("{symbol}", symbol)
-        .replace("{latest_time}", str(latest["date"]))
-        .replace("{latest_price}", str(latest["close"]))
-        .replace("{csv_data}", csv_data)
-    )
     def safe_get(key):
         val = position_info.get(key)
         if val is None or str(val).lower() == 'nan' or str(val).strip() == '':
@@ -311,78 +637,188 @@ def get_prompt_content(symbol, df, position_info):
         f"Quantity: {qty}\n"
         f"(Note: Please analyze the current trend based on this position data. If position data is N/A, analyze as a potential new entry.)"
     )
-    return base_prompt + position_text
+    return prompt_template.substitute(
+        symbol=symbol,
+        latest_time=str(df["date"].iat[-1]),
+        latest_price=str(df["close"].iat[-1]),
+        csv_data=format_kline_payload(df),
+        position_text=position_text,
+    )
+# 直接走 HTTP（复用 _SESSION 连接池），不再引入 openai SDK
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 def call_openai_official(prompt: str) -> str:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OpenAI Key missing")
     model_name = os.getenv("AI_MODEL", "gpt-4o")
-    client = OpenAI(api_key=api_key)
-    resp = client.chat.completions.create(
-        model=model_name,
-        messages=[
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    data = {
+        "model": model_name,
+        "messages": [
             {"role": "system", "content": "You are Richard D. Wyckoff."},
             {"role": "user", "content": prompt}
         ],
-        temperature=0.2
-    )
-    return resp.choices[0].message.content
+        "temperature": 0.2
+    }
+    wait_provider("openai")
+    resp = _SESSION.post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers, data=json_dumps_bytes(data), timeout=120)
+    if resp.status_code == 429:
+        defer_provider("openai", _extract_retry_seconds(resp) or 5)
+    if resp.status_code != 200:
+        raise Exception(f"OpenAI HTTP {resp.status_code}: {resp.text[:1200]}")
+    return response_json(resp)["choices"][0]["message"]["content"]
+
+# Gemini 先行；超过对冲延迟仍未返回（或已失败）则并发发起 OpenAI，取先成功者
+_LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "20"))
+def _gemini_error_label(err: Exception) -> str:
+    if isinstance(err, GeminiQuotaExceeded):
+        return "Gemini Quota Error"
+    if isinstance(err, GeminiRateLimited):
+        return "Gemini RateLimit Error"
+    return "Gemini Error"
+def hedged_gemini_openai(symbol: str, prompt: str) -> str:
+    cancel_event = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        gem_fut = pool.submit(call_gemini_http, prompt, cancel_event)
+        done, _ = wait([gem_fut], timeout=_LLM_HEDGE_DELAY)
+        if gem_fut in done and gem_fut.exception() is None:
+            return gem_fut.result()
+        if gem_fut in done:
+            err = gem_fut.exception()
+            print(f"   ⚠️ [{symbol}] {_gemini_error_label(err)}，切 OpenAI: {str(err)[:160]}...", flush=True)
+        else:
+            print(f"   ⏱️ [{symbol}] Gemini {_LLM_HEDGE_DELAY:.0f}s 未返回，并发发起 OpenAI...", flush=True)
+        gpt_fut = pool.submit(call_openai_official, prompt)
+        pending = {gem_fut, gpt_fut}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    return fut.result()
+        gem_err, gpt_err = gem_fut.exception(), gpt_fut.exception()
+        raise Exception(f"{_gemini_error_label(gem_err)}: {gem_err}. OpenAI Error: {gpt_err}")
+    finally:
+        cancel_event.set()
+        pool.shutdown(wait=False)
+
+# LLM 报告缓存：prompt（含代码、最新K线时间、K线数据、持仓）相同即复用，按文件 mtime 过期
+_LLM_CACHE_DIR = ".cache/llm"
+_LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(4 * 3600)))
+def _llm_cache_path(prompt: str) -> str:
+    return os.path.join(_LLM_CACHE_DIR, hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest() + ".txt")
+def llm_cache_get(prompt: str) -> Optional[str]:
+    path = _llm_cache_path(prompt)
+    try:
+        if time.time() - os.path.getmtime(path) < _LLM_CACHE_TTL:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+    except OSError:
+        pass
+    return None
+def llm_cache_put(prompt: str, report_text: str) -> None:
+    path = _llm_cache_path(prompt)
+    try:
+        os.makedirs(_LLM_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp.{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(report_text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"   ⚠️ LLM 缓存写入失败: {e}", flush=True)
 
 # 核心修改：AI分析逻辑优先调用DeepSeek
 def ai_analyze(symbol, df, position_info):
     prompt = get_prompt_content(symbol, df, position_info)
     if not prompt:
         return "Error: No Prompt"
+    cached = llm_cache_get(prompt)
+    if cached is not None:
+        print(f"   ♻️ [{symbol}] 命中 LLM 缓存，跳过调用", flush=True)
+        return cached
+    with _LLM_SLOTS:
+        return _ai_analyze_prompt(symbol, prompt)
+def _ai_analyze_prompt(symbol, prompt):
     # 1. 优先调用硅基流动DeepSeek（替换原Gemini优先逻辑）
     try:
         print(f"   🧠 正在调用 DeepSeek（硅基流动）分析 {symbol}...", flush=True)
-        return call_deepseek_siliconflow(prompt)
+        report_text = call_deepseek_siliconflow(prompt)
+        llm_cache_put(prompt, report_text)
+        return report_text
     except Exception as e1:
         print(f"   ⚠️ DeepSeek调用失败，尝试切换到Gemini: {str(e1)[:150]}...", flush=True)
-        # 2. DeepSeek失败后，保留原Gemini/OpenAI兜底逻辑
+        # 2. DeepSeek失败后，Gemini / OpenAI 对冲兜底
         try:
-            return call_gemini_http(prompt)
-        except GeminiQuotaExceeded as qe:
-            print(f"   ⚠️ [{symbol}] Gemini 配额耗尽，切 OpenAI: {str(qe)[:160]}...", flush=True)
-            try:
-                return call_openai_official(prompt)
-            except Exception as e2:
-                return f"Analysis Failed. DeepSeek Error: {e1}. Gemini Quota Error: {qe}. OpenAI Error: {e2}"
-        except GeminiRateLimited as rl:
-            print(f"   ⚠️ [{symbol}] Gemini 短期限流，切 OpenAI: {str(rl)[:160]}...", flush=True)
-            try:
-                return call_openai_official(prompt)
-            except Exception as e2:
-                return f"Analysis Failed. DeepSeek Error: {e1}. Gemini RateLimit Error: {rl}. OpenAI Error: {e2}"
+            report_text = hedged_gemini_openai(symbol, prompt)
+            llm_cache_put(prompt, report_text)
+            return report_text
         except Exception as e2:
-            print(f"   ⚠️ [{symbol}] Gemini 失败，切 OpenAI: {str(e2)[:160]}...", flush=True)
-            try:
-                return call_openai_official(prompt)
-            except Exception as e3:
-                return f"Analysis Failed. DeepSeek Error: {e1}. Gemini Error: {e2}. OpenAI Error: {e3}"
+            return f"Analysis Failed. DeepSeek Error: {e1}. {e2}"
 
 # ==========================================
 # 4. PDF 生成模块（完全保留原代码，不修改）
 # ==========================================
-def generate_pdf_report(symbol, chart_path, report_text, pdf_path):
-    html_content = markdown.markdown(report_text)
-    abs_chart_path = os.path.abspath(chart_path)
-    font_path = "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc"
-    if not os.path.exists(font_path):
-        font_path = "msyh.ttc"
-    full_html = f"""
-    <html>
+# 字体探测与 <head> 样式只构建一次，所有报告共用
+_PDF_HEAD = None
+_PDF_FONT = "MyChineseFont"
+# PDF 引擎：xhtml2pdf（默认）/ weasyprint（需自行安装 weasyprint 及 pango，缺失时回退 xhtml2pdf）
+PDF_ENGINE = os.getenv("PDF_ENGINE", "xhtml2pdf").lower()
+def _use_weasyprint() -> bool:
+    global PDF_ENGINE
+    if PDF_ENGINE == "weasyprint":
+        try:
+            import weasyprint  # noqa: F401
+        except (ImportError, OSError) as e:
+            print(f"   ⚠️ WeasyPrint 不可用，回退 xhtml2pdf: {e}", flush=True)
+            PDF_ENGINE = "xhtml2pdf"
+    return PDF_ENGINE == "weasyprint"
+def _register_pdf_font(font_path: str) -> bool:
+    """中文字体只向 reportlab 注册一次；否则每份报告都要经 @font-face 重新解析数 MB 的 TTC"""
+    try:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        from xhtml2pdf.default import DEFAULT_FONT
+        pdfmetrics.registerFont(TTFont(_PDF_FONT, font_path))
+        DEFAULT_FONT[_PDF_FONT.lower()] = _PDF_FONT
+        return True
+    except Exception as e:
+        print(f"   ⚠️ 字体预注册失败，回退 @font-face: {e}", flush=True)
+        return False
+def _pdf_head() -> str:
+    global _PDF_HEAD
+    if _PDF_HEAD is None:
+        font_path = "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc"
+        if not os.path.exists(font_path):
+            font_path = "msyh.ttc"
+        # WeasyPrint 经 fontconfig 缓存字体，直接走 @font-face
+        registered = not _use_weasyprint() and _register_pdf_font(font_path)
+        font_face = "" if registered else f'@font-face {{ font-family: "{_PDF_FONT}"; src: url("{font_path}"); }}'
+        _PDF_HEAD = f"""
     <head>
         <meta charset="utf-8">
         <style>
-            @font-face {{ font-family: "MyChineseFont"; src: url("{font_path}"); }}
+            {font_face}
             @page {{ size: A4; margin: 1cm; }}
             body {{ font-family: "MyChineseFont", sans-serif; font-size: 12px; line-height: 1.5; }}
             h1, h2, h3, p, div {{ font-family: "MyChineseFont", sans-serif; color: #2c3e50; }}
             img {{ width: 18cm; margin-bottom: 20px; }}
             .header {{ text-align: center; margin-bottom: 20px; color: #7f8c8d; font-size: 10px; }}
         </style>
-    </head>
+    </head>"""
+    return _PDF_HEAD
+# Markdown 解析器实例非线程安全：每个线程复用一个，convert 前 reset，省去每份报告重建扩展与处理器
+_MD_LOCAL = threading.local()
+def render_markdown(text: str) -> str:
+    md = getattr(_MD_LOCAL, "md", None)
+    if md is None:
+        import markdown
+        md = _MD_LOCAL.md = markdown.Markdown()
+    return md.reset().convert(text)
+def generate_pdf_report(symbol, chart_path, report_text, pdf_path):
+    html_content = render_markdown(report_text)
+    abs_chart_path = os.path.abspath(chart_path)
+    full_html = f"""
+    <html>{_pdf_head()}
     <body>
         <div class="header">Wyckoff Quantitative Analysis | {symbol}</div>
         <img src="{abs_chart_path}" />
@@ -392,7 +828,13 @@ def generate_pdf_report(symbol, chart_path, report_text, pdf_path):
     </html>
     """
     try:
-        with open(pdf_path, "wb") as pdf_file:
+        if _use_weasyprint():
+            from weasyprint import HTML
+            with _RENDER_LOCK:
+                HTML(string=full_html, base_url=os.getcwd()).write_pdf(pdf_path)
+            return True
+        from xhtml2pdf import pisa
+        with _RENDER_LOCK, open(pdf_path, "wb") as pdf_file:
             pisa.CreatePDF(full_html, dest=pdf_file)
         return True
     except:
@@ -401,31 +843,97 @@ def generate_pdf_report(symbol, chart_path, report_text, pdf_path):
 # ==========================================
 # 5. 主程序（完全保留原代码，不修改）
 # ==========================================
-def process_one_stock(symbol: str, position_info: dict):
+# 数据快照格式：csv（默认）/ parquet（需安装 pyarrow，缺失时回退 csv）/ none（不落盘）
+DATA_FORMAT = os.getenv("DATA_FORMAT", "csv").lower()
+# 数据快照落盘不影响后续流程，交给后台线程写，main() 结束前统一等待
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+_IO_FUTURES: list = []
+def save_data_snapshot(df: pd.DataFrame, base_path: str) -> Optional[str]:
+    if DATA_FORMAT == "none":
+        return None
+    if DATA_FORMAT == "parquet":
+        try:
+            df.to_parquet(f"{base_path}.parquet", compression="snappy", index=False)
+            return f"{base_path}.parquet"
+        except ImportError:
+            pass
+    df.to_csv(f"{base_path}.csv", index=False, encoding="utf-8-sig")
+    return f"{base_path}.csv"
+def prepare_stock(symbol: str, position_info: dict, date_range: Optional[tuple] = None) -> Optional[dict]:
+    """取数（含指标） + 落盘数据快照 + 绘图，返回后续 AI/PDF 所需上下文"""
     if position_info is None:
         position_info = {}
-    clean_digits = ''.join(filter(str.isdigit, str(symbol)))
-    clean_symbol = clean_digits.zfill(6)
+    clean_symbol = format_stock_code(symbol)
     print(f"🚀 [{clean_symbol}] 开始分析...", flush=True)
-    data_res = fetch_stock_data_dynamic(clean_symbol, position_info.get('date'))
+    data_res = fetch_stock_data_dynamic(clean_symbol, position_info.get('date'), date_range)
     df = data_res["df"]
     period = data_res["period"]
     if df.empty:
         print(f"   ⚠️ [{clean_symbol}] 数据为空，跳过", flush=True)
         return None
-    df = add_indicators(df)
     beijing_tz = timezone(timedelta(hours=8))
     ts = datetime.now(beijing_tz).strftime("%Y%m%d_%H%M%S")
-    csv_path = f"data/{clean_symbol}_{period}_{ts}.csv"
-    df.to_csv(csv_path, index=False, encoding="utf-8-sig")
+    _IO_FUTURES.append(_IO_POOL.submit(save_data_snapshot, df, f"data/{clean_symbol}_{period}_{ts}"))
     chart_path = f"reports/{clean_symbol}_chart_{ts}.png"
     pdf_path = f"reports/{clean_symbol}_report_{period}_{ts}.pdf"
     generate_local_chart(clean_symbol, df, chart_path, period)
-    report_text = ai_analyze(clean_symbol, df, position_info)
-    if generate_pdf_report(clean_symbol, chart_path, report_text, pdf_path):
-        print(f"✅ [{clean_symbol}] 报告生成完毕", flush=True)
-        return pdf_path
+    return {"symbol": clean_symbol, "df": df, "position_info": position_info, "chart_path": chart_path, "pdf_path": pdf_path}
+def finish_stock(ctx: dict, report_text: str) -> Optional[str]:
+    if generate_pdf_report(ctx["symbol"], ctx["chart_path"], report_text, ctx["pdf_path"]):
+        print(f"✅ [{ctx['symbol']}] 报告生成完毕", flush=True)
+        return ctx["pdf_path"]
     return None
+def process_one_stock(symbol: str, position_info: dict, date_range: Optional[tuple] = None):
+    ctx = prepare_stock(symbol, position_info, date_range)
+    if ctx is None:
+        return None
+    report_text = ai_analyze(ctx["symbol"], ctx["df"], ctx["position_info"])
+    return finish_stock(ctx, report_text)
+def process_stock_batch(batch: list, date_range: Optional[tuple] = None) -> list:
+    """一组股票共用一次 LLM 请求（DeepSeek，失败则 Gemini）；批量结果缺失的股票走单只 ai_analyze 兜底"""
+    if len(batch) == 1:
+        return [process_one_stock(*batch[0], date_range)]
+    ctxs = []
+    for symbol, info in batch:
+        try:
+            ctx = prepare_stock(symbol, info, date_range)
+            if ctx:
+                ctxs.append(ctx)
+        except Exception as e:
+            print(f"❌ [{symbol}] 处理发生异常: {e}", flush=True)
+    prompts = {}
+    reports = {}
+    for ctx in ctxs:
+        prompt = get_prompt_content(ctx["symbol"], ctx["df"], ctx["position_info"])
+        if not prompt:
+            continue
+        cached = llm_cache_get(prompt)
+        if cached is not None:
+            reports[ctx["symbol"]] = cached
+        else:
+            prompts[ctx["symbol"]] = prompt
+    # 批量依次尝试 DeepSeek、Gemini；都失败（或结果缺失）的股票再逐只分析
+    for name, batch_fn in (("DeepSeek", call_deepseek_siliconflow_batch), ("Gemini", call_gemini_http_batch)):
+        if len(prompts) < 2:
+            break
+        try:
+            print(f"   🧠 正在批量调用 {name} 分析 {', '.join(prompts)}...", flush=True)
+            with _LLM_SLOTS:
+                batch_reports = batch_fn(prompts)
+            for symbol, report_text in batch_reports.items():
+                llm_cache_put(prompts[symbol], report_text)
+            reports.update(batch_reports)
+            break
+        except Exception as e:
+            print(f"   ⚠️ {name} 批量调用失败: {str(e)[:150]}...", flush=True)
+    results = []
+    for ctx in ctxs:
+        try:
+            report_text = reports.get(ctx["symbol"]) or ai_analyze(ctx["symbol"], ctx["df"], ctx["position_info"])
+            results.append(finish_stock(ctx, report_text))
+        except Exception as e:
+            print(f"❌ [{ctx['symbol']}] 处理发生异常: {e}", flush=True)
+    return results
 def main():
     os.makedirs("data", exist_ok=True)
     os.makedirs("reports", exist_ok=True)
@@ -439,16 +947,28 @@ def main():
         return
     generated_pdfs = []
     items = list(stocks_dict.items())
-    for i, (symbol, info) in enumerate(items):
+    print("📡 后台并发预取K线...", flush=True)
+    date_range = kline_date_range()
+    prefetch_klines(stocks_dict.keys(), date_range, block=False)
+    # I/O 密集（行情 + LLM），线程池并发；LLM 调用由令牌桶限流
+    # DEEPSEEK_BATCH_SIZE>1 时每组股票合并为一次 DeepSeek 请求
+    max_workers = int(os.getenv("MAX_CONCURRENCY") or os.getenv("CONCURRENCY") or os.getenv("MAX_WORKERS") or "6")
+    batch_size = max(1, int(os.getenv("DEEPSEEK_BATCH_SIZE", "1")))
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(batch, pool.submit(process_stock_batch, batch, date_range)) for batch in batches]
+        for batch, fut in futures:
+            try:
+                generated_pdfs.extend(p for p in fut.result() if p)
+            except Exception as e:
+                print(f"❌ [{', '.join(s for s, _ in batch)}] 处理发生异常: {e}", flush=True)
+    for fut in _IO_FUTURES:
         try:
-            pdf_path = process_one_stock(symbol, info)
-            if pdf_path:
-                generated_pdfs.append(pdf_path)
+            fut.result()
         except Exception as e:
-            print(f"❌ [{symbol}] 处理发生异常: {e}", flush=True)
-        if i < len(items) - 1:
-            print("⏳ 强制冷却 60秒 (防止 API 429)...", flush=True)
-            time.sleep(60)
+            print(f"   ⚠️ 数据快照写入失败: {e}", flush=True)
+    # 模块级线程池不在这里 shutdown（同一进程再次调用 main() 仍要用），只清空本轮已等待的任务
+    _IO_FUTURES.clear()
     if generated_pdfs:
         print(f"\n📝 生成推送清单 ({len(generated_pdfs)}):", flush=True)
         with open("push_list.txt", "w", encoding="utf-8") as f:
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import requests
+from collections import deque
+from urllib3.exceptions import ProtocolError
+from pathlib import Path
+from http_session import build_session, response_json, telegram_url
+
+_SESSION = build_session()
+MEDIA_GROUP_SIZE = 10  # Telegram sendMediaGroup 单次上限
+CAPTION_LIMIT = 1024   # 文件说明长度上限，超出整条请求会被拒
+# 单个会话 20 条/分钟；媒体组里每个文件各算一条
+CHAT_LIMIT = 20
+_CHAT_SENT = deque(maxlen=CHAT_LIMIT)
+
+def read_push_list(path="push_list.txt"):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [p for p in lines if p and os.path.isfile(p)]
+
+def make_caption(pdf_path):
+    return f"Analysis: {os.path.basename(pdf_path)}"[:CAPTION_LIMIT]
+
+def pdf_part(pdf_path):
+    """一次性读入文件字节：requests 本就会把 multipart 整体放进内存，无需保持句柄打开"""
+    return (os.path.basename(pdf_path), Path(pdf_path).read_bytes(), "application/pdf")
+
+def _antiflood(n_messages):
+    """发送前按会话限额排队，n_messages 为这次请求计入的消息条数"""
+    for _ in range(n_messages):
+        if len(_CHAT_SENT) == _CHAT_SENT.maxlen:
+            wait_s = 60.0 - (time.monotonic() - _CHAT_SENT[0])
+            if wait_s > 0:
+                time.sleep(wait_s)
+        _CHAT_SENT.append(time.monotonic())
+
+class DeliveryUnknown(Exception):
+    """请求可能已被 Telegram 接收（如上传后读超时），不能补发，否则会重复推送"""
+
+def _post(url, n_messages, **kwargs):
+    """限速 + 429 按 retry_after 重试。
+    连接失败（请求没发出去）返回 None，调用方可补发；其它异常无法确认是否送达，抛 DeliveryUnknown"""
+    resp = None
+    for attempt in range(1, 4):
+        _antiflood(n_messages)
+        try:
+            resp = _SESSION.post(url, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            # ProtocolError = 连接建立后被断开（Connection aborted），上传可能已完成
+            if e.args and isinstance(e.args[0], ProtocolError):
+                raise DeliveryUnknown(e) from e
+            print(f"   ⚠️ Telegram 连接失败: {e}")
+            return None
+        except Exception as e:
+            raise DeliveryUnknown(e) from e
+        if resp.status_code != 429:
+            return resp
+        try:
+            retry_after = int(response_json(resp).get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            retry_after = 1
+        print(f"   ⚠️ Telegram 429 限流，等待 {retry_after}s 后重试 ({attempt}/3)")
+        time.sleep(retry_after + 0.1)
+    return resp
+
+def send_document(bot_token, chat_id, pdf_path):
+    url = telegram_url(bot_token, "sendDocument")
+    resp = _post(
+        url,
+        1,
+        data={"chat_id": chat_id, "caption": make_caption(pdf_path)},
+        files={"document": pdf_part(pdf_path)},
+        timeout=120,
+    )
+    return resp is not None and resp.status_code == 200
+
+def send_media_group(bot_token, chat_id, pdf_paths):
+    """一次请求推送 2~10 个 PDF，每个文件各带自己的说明"""
+    url = telegram_url(bot_token, "sendMediaGroup")
+    media = []
+    files = {}
+    for i, pdf_path in enumerate(pdf_paths):
+        name = f"f{i}"
+        media.append({"type": "document", "media": f"attach://{name}", "caption": make_caption(pdf_path)})
+        files[name] = pdf_part(pdf_path)
+    resp = _post(
+        url,
+        len(pdf_paths),
+        data={"chat_id": chat_id, "media": json.dumps(media, ensure_ascii=False)},
+        files=files,
+        timeout=300,
+    )
+    if resp is None:
+        return False
+    if resp.status_code != 200:
+        print(f"   ⚠️ sendMediaGroup 失败: HTTP {resp.status_code} {resp.text[:200]}")
+        return False
+    return True
+
+def main():
+    bot_token = os.getenv("TG_BOT_TOKEN")
+    chat_id = os.getenv("TG_CHAT_ID")
+    if not bot_token or not chat_id:
+        print("❌ 缺少 TG_BOT_TOKEN / TG_CHAT_ID")
+        return
+
+    pdfs = read_push_list()
+    if pdfs is None:
+        print("::warning::File push_list.txt not found.")
+        return
+
+    print("=== Start Pushing ===")
+    for start in range(0, len(pdfs), MEDIA_GROUP_SIZE):
+        group = pdfs[start:start + MEDIA_GROUP_SIZE]
+        print(f"Sending: {', '.join(os.path.basename(p) for p in group)}")
+        # sendMediaGroup 至少需要 2 个文件；批量失败时逐个补发
+        try:
+            if len(group) > 1 and send_media_group(bot_token, chat_id, group):
+                print("Sent.")
+            else:
+                for pdf_path in group:
+                    try:
+                        ok = send_document(bot_token, chat_id, pdf_path)
+                        print(f"{'Sent' if ok else 'Failed'}: {pdf_path}")
+                    except DeliveryUnknown as e:
+                        print(f"Unconfirmed (not resent): {pdf_path} ({e})")
+                    time.sleep(3)
+        except DeliveryUnknown as e:
+            print(f"Unconfirmed (not resent): {e}")
+        time.sleep(3)
+    print("=== Finished ===")
+
+if __name__ == "__main__":
+    main()
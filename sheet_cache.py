@@ -0,0 +1,68 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class FileCache:
+    """内存 + 磁盘 JSON 的 TTL 缓存（按表格 ID 分文件）"""
+
+    def __init__(self, namespace, ttl=60, cache_dir=".cache/sheets"):
+        digest = hashlib.md5(str(namespace).encode("utf-8")).hexdigest()
+        self.path = os.path.join(cache_dir, f"{digest}.json")
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+        return self._entries
+
+    def _flush(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"   ⚠️ 缓存写入失败: {e}")
+
+    def get(self, key, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._load().get(key)
+            if entry and time.time() - entry.get("ts", 0) < ttl:
+                return entry.get("payload")
+        return None
+
+    def set(self, key, payload):
+        with self._lock:
+            self._load()[key] = {"ts": time.time(), "payload": payload}
+            self._flush()
+
+    def get_or_set(self, key, fetch_fn, ttl=None):
+        """命中且未过期直接返回；否则调用 fetch_fn 拉取并写回缓存"""
+        with self._lock:
+            payload = self.get(key, ttl)
+            if payload is not None:
+                return payload
+            payload = fetch_fn()
+            self.set(key, payload)
+            return payload
+
+    def invalidate(self, key=None):
+        with self._lock:
+            entries = self._load()
+            if key is None:
+                entries.clear()
+            else:
+                entries.pop(key, None)
+            self._flush()
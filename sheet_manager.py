@@ -1,122 +1,287 @@
 import os
+import re
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import time
+import random
+import functools
+import itertools
+from sheet_cache import FileCache
+
+_NON_DIGIT_RE = re.compile(r"\D")
+
+def format_stock_code(raw):
+    """只保留数字并补足 6 位（修复表格丢前导零），正则在 C 层完成过滤"""
+    s = str(raw)
+    if s.isascii() and s.isdigit():
+        return s.zfill(6)  # 表格里绝大多数是纯数字，跳过正则替换
+    return _NON_DIGIT_RE.sub("", s).zfill(6)
+
+def format_change(action_type, clean_symbol, date="", price="", qty=""):
+    """单只股票变动的回复文本（单条与批量写入共用）"""
+    return (
+        f"{action_type} {clean_symbol}\n"
+        f"本次变动: {date or '-'} | {price or '-'} | {qty or '-'}"
+    )
+
+_RETRY_STATUS = (429, 500, 503)
+_RETRY_ATTEMPTS = 5
+
+def _retry(fn, *args, **kwargs):
+    """Sheets API 偶发的 429/5xx 按指数退避 + 抖动重试。
+    写操作都是 POST，连接池适配器不会重试，必须在这里兜底"""
+    from gspread.exceptions import APIError
+
+    for attempt in range(_RETRY_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except APIError as e:
+            status = getattr(e.response, "status_code", None)
+            if status not in _RETRY_STATUS or attempt == _RETRY_ATTEMPTS - 1:
+                raise
+            wait_s = 2 ** attempt + random.random()
+            print(f"   ⚠️ Sheets API {status}，{wait_s:.1f}s 后重试 ({attempt + 1}/{_RETRY_ATTEMPTS - 1})")
+            time.sleep(wait_s)
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+
+@functools.lru_cache(maxsize=1)
+def _authorized_client(raw_key):
+    """按凭证内容缓存已认证客户端：JSON 解析、私钥加载、JWT 签发只做一次（过期由 google-auth 自动刷新）"""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    try:
+        creds_dict = json.loads(raw_key)
+    except json.JSONDecodeError:
+        raise ValueError("❌ GCP_SA_KEY JSON 解析失败，请检查格式")
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    client = gspread.authorize(creds)
+    # gspread 自带的 AuthorizedSession 换上共享的连接池 + 429/5xx 退避重试（兼容 gspread 5 / 6）
+    from http_session import build_adapter
+    session = getattr(getattr(client, "http_client", client), "session", None)
+    if session is not None:
+        session.mount("https://", build_adapter(pool_connections=4, pool_maxsize=10))
+    return client
 
 class SheetManager:
     def __init__(self):
-        # 1. 获取凭证
-        raw_key = os.getenv("GCP_SA_KEY")
-        if not raw_key:
+        # 构造时只校验配置，认证与打开表格推迟到第一次真正访问（缓存命中时完全不连网）
+        self._raw_key = os.getenv("GCP_SA_KEY")
+        if not self._raw_key:
             raise ValueError("❌ 环境变量 GCP_SA_KEY 未找到")
-        
-        try:
-            creds_dict = json.loads(raw_key)
-            creds = Credentials.from_service_account_info(
-                creds_dict,
-                scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-            )
-        except json.JSONDecodeError:
-            raise ValueError("❌ GCP_SA_KEY JSON 解析失败，请检查格式")
-
-        # 2. 连接客户端
+
+        self._sheet_target = os.getenv("SHEET_NAME")
+        if not self._sheet_target:
+            raise ValueError("❌ 环境变量 SHEET_NAME 未找到")
+
+        self.cache = FileCache(self._sheet_target, ttl=int(os.getenv("SHEET_CACHE_TTL", "60")))
+        # 快照未变时复用上次的解析结果与 代码->行号 索引
+        self._parsed_from = None
+        self._parsed = {}
+        self._row_index = {}
+
+    @functools.cached_property
+    def client(self):
         print("   >>> [System] 初始化 Google Sheets (智能连接版)...")
         try:
-            self.client = gspread.authorize(creds)
+            client = _authorized_client(self._raw_key)
             print("   ✅ Google Auth 认证成功")
+        except ValueError:
+            raise
         except Exception as e:
             raise Exception(f"❌ Google Auth 失败: {e}")
+        return client
 
-        # 3. 连接表格
-        sheet_name_or_id = os.getenv("SHEET_NAME")
-        if not sheet_name_or_id:
-            raise ValueError("❌ 环境变量 SHEET_NAME 未找到")
+    @functools.cached_property
+    def sh(self):
+        # 延迟导入：只有真正连接表格时才加载 gspread / google-auth
+        import gspread
 
+        sheet_name_or_id = self._sheet_target
         try:
             if len(sheet_name_or_id) > 20: 
-                self.sh = self.client.open_by_key(sheet_name_or_id)
+                sh = _retry(self.client.open_by_key, sheet_name_or_id)
                 print(f"   ✅ [成功] 已通过 ID 连接到表格！")
             else:
                 print(f"   >>> 正在尝试按【文件名】打开: '{sheet_name_or_id}'...")
-                self.sh = self.client.open(sheet_name_or_id)
+                sh = _retry(self.client.open, sheet_name_or_id)
                 print(f"   ✅ [成功] 已通过文件名连接到表格！")
         except gspread.SpreadsheetNotFound:
             print(f"   ❌ 找不到名为 '{sheet_name_or_id}' 的表格。")
             raise
+        return sh
+
+    @functools.cached_property
+    def sheet(self):
+        return self.sh.sheet1
 
-        self.sheet = self.sh.sheet1
+    def _snapshot(self):
+        """当前表格快照（走缓存）；快照变化时重建解析结果和行号索引"""
+        all_values = self.cache.get_or_set("all_values", lambda: _retry(self.sheet.get_all_values))
+        if all_values is not self._parsed_from:
+            self._parsed = self._parse_rows(all_values)
+            self._row_index = self._index_rows(all_values)
+            self._parsed_from = all_values
+        return all_values
+
+    def _find_row(self, clean_symbol):
+        """按 A 列代码查行号（1 起，含表头），代替每次一次全表扫描的 sheet.find。
+        结果用于按行号写入/删除，必须基于最新表格：先作废缓存再读一次，旧快照的行号可能已错位"""
+        self.cache.invalidate("all_values")
+        self._snapshot()
+        return self._row_index.get(clean_symbol)
 
     def get_all_stocks(self):
         """获取所有股票配置"""
-        all_values = self.sheet.get_all_values()
-        if not all_values: return {}
-        
-        data_rows = all_values[1:]
-        stocks = {}
-        for row in data_rows:
+        self._snapshot()
+        return {symbol: dict(info) for symbol, info in self._parsed.items()}
+
+    @staticmethod
+    def _data_rows(all_values):
+        """跳过表头逐行产出 (行号, 行)，不复制 all_values[1:]"""
+        return enumerate(itertools.islice(all_values, 1, None), start=2)
+
+    @staticmethod
+    def _index_rows(all_values):
+        index = {}
+        for row_no, row in SheetManager._data_rows(all_values):
+            if row and row[0].strip():
+                index.setdefault(format_stock_code(row[0]), row_no)
+        return index
+
+    @staticmethod
+    def _iter_rows(all_values):
+        """逐行产出 (代码, 配置)，由调用方决定是否落成 dict"""
+        for _, row in SheetManager._data_rows(all_values):
             if not row or not row[0].strip(): continue
             
-            raw_symbol = row[0].strip()
-            digits = ''.join(filter(str.isdigit, raw_symbol))
-            symbol = digits.zfill(6)
+            symbol = format_stock_code(row[0])
             
             # 安全获取
             buy_date = row[1].strip() if len(row) > 1 else ""
             price = row[2].strip() if len(row) > 2 else ""
             qty = row[3].strip() if len(row) > 3 else ""
             
-            stocks[symbol] = {"date": buy_date, "price": price, "qty": qty}
-        return stocks
+            yield symbol, {"date": buy_date, "price": price, "qty": qty}
+
+    @staticmethod
+    def _parse_rows(all_values):
+        return dict(SheetManager._iter_rows(all_values))
+
+    @staticmethod
+    def _changed_cells(row, current, date, price, qty):
+        """与当前行比对，只返回非空且有变化的单元格写入"""
+        return [
+            {"range": f"{col}{row}", "values": [[str(val)]]}
+            for col, key, val in (("B", "date", date), ("C", "price", price), ("D", "qty", qty))
+            if val and str(val).strip() != current.get(key)
+        ]
 
     def add_or_update_stock(self, symbol, date='', price='', qty=''):
         """添加或更新"""
-        clean_symbol = ''.join(filter(str.isdigit, str(symbol))).zfill(6)
+        clean_symbol = format_stock_code(symbol)
         print(f"   🔍 正在查找股票: {clean_symbol}")
         
         try:
-            cell = self.sheet.find(clean_symbol)
+            row = self._find_row(clean_symbol)
             action_type = ""
             
-            if cell:
-                print(f"   Found at Row {cell.row}. Updating...")
-                row = cell.row
-                if date: self.sheet.update_cell(row, 2, str(date))
-                if price: self.sheet.update_cell(row, 3, str(price))
-                if qty: self.sheet.update_cell(row, 4, str(qty))
-                action_type = "✅ 已更新"
+            if row:
+                # 只写与最新行不同的非空字段，一次 batch_update 提交；全部相同则不发写请求
+                current = self._parsed.get(clean_symbol, {})
+                updates = self._changed_cells(row, current, date, price, qty)
+                if updates:
+                    print(f"   Found at Row {row}. Updating...")
+                    _retry(self.sheet.batch_update, updates, value_input_option="USER_ENTERED")
+                    self.cache.invalidate("all_values")
+                    action_type = "✅ 已更新"
+                else:
+                    print(f"   Found at Row {row}. 数值未变化，跳过写入")
+                    action_type = "✅ 无变化"
             else:
                 print(f"   Not found. Appending new row...")
-                self.sheet.append_row([clean_symbol, str(date), str(price), str(qty)])
+                _retry(self.sheet.append_row, [clean_symbol, str(date), str(price), str(qty)])
+                self.cache.invalidate("all_values")
                 action_type = "🆕 新增关注"
 
-            show_date = date if date else "-"
-            show_price = price if price else "-"
-            show_qty = qty if qty else "-"
-
-            return (
-                f"{action_type} {clean_symbol}\n"
-                f"本次变动: {show_date} | {show_price} | {show_qty}"
-            )
+            return format_change(action_type, clean_symbol, date, price, qty)
                 
         except Exception as e:
             print(f"   ❌ 操作表格失败: {e}")
             raise e
 
+    def add_or_update_many(self, stocks):
+        """批量添加或更新：stocks 格式同 get_all_stocks，{代码: {"date", "price", "qty"}}
+        读表一次，所有更新合并为一次 batch_update，新代码合并为一次 append_rows"""
+        all_values = _retry(self.sheet.get_all_values)
+        row_of = self._index_rows(all_values)
+        current_of = self._parse_rows(all_values)
+
+        updates, new_rows = [], {}
+        updated, unchanged = [], []
+        for symbol, info in stocks.items():
+            clean_symbol = format_stock_code(symbol)
+            date, price, qty = (str(info.get(k) or "") for k in ("date", "price", "qty"))
+            row = row_of.get(clean_symbol)
+            if row:
+                cells = self._changed_cells(row, current_of.get(clean_symbol, {}), date, price, qty)
+                updates.extend(cells)
+                (updated if cells else unchanged).append(clean_symbol)
+            elif clean_symbol in new_rows:
+                # 同一批里重复的新代码：合并到待追加的那一行
+                pending = new_rows[clean_symbol]
+                for i, val in ((1, date), (2, price), (3, qty)):
+                    if val:
+                        pending[i] = val
+            else:
+                new_rows[clean_symbol] = [clean_symbol, date, price, qty]
+
+        if updates:
+            _retry(self.sheet.batch_update, updates, value_input_option="USER_ENTERED")
+        if new_rows:
+            # 与 append_row 一致走默认 RAW：USER_ENTERED 会把 "000001" 解析成数字 1
+            _retry(self.sheet.append_rows, list(new_rows.values()))
+        if updates or new_rows:
+            self.cache.invalidate("all_values")
+        print(f"   ✅ 批量写入: 更新 {len(updated)} 只, 新增 {len(new_rows)} 只, 无变化 {len(unchanged)} 只")
+        return {"updated": updated, "added": list(new_rows), "unchanged": unchanged}
+
     def remove_stock(self, symbol):
         """删除指定的股票行"""
-        clean_symbol = ''.join(filter(str.isdigit, str(symbol))).zfill(6)
+        clean_symbol = format_stock_code(symbol)
         print(f"   🔍 正在查找要删除的股票: {clean_symbol}")
         
         try:
-            cell = self.sheet.find(clean_symbol)
-            if cell:
-                self.sheet.delete_rows(cell.row)
+            row = self._find_row(clean_symbol)
+            if row:
+                _retry(self.sheet.delete_rows, row)
+                self.cache.invalidate("all_values")
                 return f"🗑️ 已移除 {clean_symbol}"
             else:
                 return f"⚠️ 未找到 {clean_symbol}"
         except Exception as e:
             return f"❌ 删除失败: {e}"
 
+    def remove_many(self, symbols):
+        """批量删除：按最新行号组装 deleteDimension，一次 spreadsheets.batchUpdate 提交。
+        从下往上删，前面的行号不会因删除而错位"""
+        row_of = self._index_rows(_retry(self.sheet.get_all_values))
+        removed, missing = [], []
+        for symbol in dict.fromkeys(format_stock_code(s) for s in symbols):
+            (removed if symbol in row_of else missing).append(symbol)
+        if removed:
+            sheet_id = self.sheet.id
+            requests = [
+                {"deleteDimension": {"range": {
+                    "sheetId": sheet_id, "dimension": "ROWS", "startIndex": row - 1, "endIndex": row,
+                }}}
+                for row in sorted((row_of[s] for s in removed), reverse=True)
+            ]
+            _retry(self.sh.batch_update, {"requests": requests})
+            self.cache.invalidate("all_values")
+        print(f"   🗑️ 批量删除: {len(removed)} 只, 未找到 {len(missing)} 只")
+        return {"removed": removed, "missing": missing}
+
     # === 👇 新增：获取全部持仓文本摘要 ===
     def get_portfolio_summary(self):
         """返回格式化后的所有持仓列表字符串"""